@@ -23,6 +23,7 @@ from absl import flags
 
 import collections
 import math
+import numpy as np
 import pynini as py
 import random
 import sys
@@ -37,15 +38,98 @@ flags.DEFINE_bool("initial_only", False,
                   "If true, use only the initial sounds from the pairs, "
                   "per Kessler's approach. Only functional if --use_aligner "
                   "is true")
+flags.DEFINE_integer("permutations", 0,
+                     "If nonzero, also estimates the probability of the number "
+                     "of matches with this many random permutations of the "
+                     "second column, per Kessler's permutation test.")
 
 FLAGS = flags.FLAGS
 
 
+class Prefilter:
+  """Rejects pairs that a single-state aligner cannot align at all.
+
+  The aligner's arcs are given as pairs of symbols, with None for epsilon. A
+  pair can be aligned iff the first string can be rewritten as the second
+  using only those substitutions, deletions and insertions, which is checked
+  here without building any FSTs. The cheaper length and partner checks come
+  first; the counts of pairs rejected at each stage are kept in self.rejected.
+  """
+
+  def __init__(self, mappings):
+    self.rejected = collections.defaultdict(int)
+    self._deletable = set()
+    self._insertable = set()
+    self._pairs = set()
+    for (left, right) in mappings:
+      if left is None and right is not None:
+        self._insertable.add(right)
+      elif right is None and left is not None:
+        self._deletable.add(left)
+      elif left is not None:
+        self._pairs.add((left, right))
+    self._bits = {}
+    for pair in self._pairs:
+      for c in pair:
+        self._bits.setdefault(c, 1 << len(self._bits))
+    # Bitmasks of the allowed partners of each symbol, in each direction.
+    self._partners1 = collections.defaultdict(int)
+    self._partners2 = collections.defaultdict(int)
+    for (left, right) in self._pairs:
+      self._partners1[left] |= self._bits[right]
+      self._partners2[right] |= self._bits[left]
+
+  def _mask(self, string):
+    mask = 0
+    for c in string:
+      mask |= self._bits.get(c, 0)
+    return mask
+
+  def feasible(self, p1, p2):
+    """Returns False if p1 can certainly not be aligned with p2."""
+    # Symbols that cannot be deleted (inserted) each need a partner.
+    if (sum(1 for c in p1 if c not in self._deletable) > len(p2) or
+        sum(1 for c in p2 if c not in self._insertable) > len(p1)):
+      self.rejected["length"] += 1
+      return False
+    mask1 = self._mask(p1)
+    mask2 = self._mask(p2)
+    for c in p1:
+      if c not in self._deletable and not self._partners1[c] & mask2:
+        self.rejected["partners"] += 1
+        return False
+    for c in p2:
+      if c not in self._insertable and not self._partners2[c] & mask1:
+        self.rejected["partners"] += 1
+        return False
+    # reachable[j] is True if p1[:i] can be rewritten as p2[:j].
+    reachable = [True] * (len(p2) + 1)
+    for j in range(len(p2)):
+      reachable[j + 1] = reachable[j] and p2[j] in self._insertable
+    for i in range(len(p1)):
+      row = [reachable[0] and p1[i] in self._deletable]
+      for j in range(len(p2)):
+        row.append((reachable[j] and (p1[i], p2[j]) in self._pairs) or
+                   (reachable[j + 1] and p1[i] in self._deletable) or
+                   (row[j] and p2[j] in self._insertable))
+      reachable = row
+    if not reachable[-1]:
+      self.rejected["alignment"] += 1
+      return False
+    return True
+
+
 class Aligner:
   """Class to perform alignments using a constructed FST."""
 
   def __init__(self):
     self._stats = collections.defaultdict(int)
+    # Learned matching criterion, set by compute_alignments: either the
+    # allowed pairs of initials, or the symbols and prefilter of the pared down
+    # aligner.
+    self._allowed = None
+    self._symbols = None
+    self._prefilter = None
     self._aligner = py.Fst()
     s = self._aligner.add_state()
     self._aligner.set_start(s)
@@ -75,6 +159,11 @@ class Aligner:
       for (p1, p2) in pairs:
         new_pairs.append((p1[:1], p2[:1]))
       pairs = new_pairs
+      # Empty forms can only be handled by the general FST path.
+      if all(p1 and p2 for (p1, p2) in pairs):
+        return self._compute_initial_alignments(pairs, max_zeroes,
+                                                max_allowed_mappings,
+                                                print_mappings)
     # Computes initial statistics for any symbol mapping to any symbol assuming
     # no reordering.
     for (p1, p2) in pairs:
@@ -160,6 +249,14 @@ class Aligner:
         right = right.replace("<epsilon>", "Ø")
         print("{}\t->\t{}".format(left, right))
     self._aligner = new_aligner
+    self._allowed = None
+    self._symbols = symbols
+    # Pairs the pared down aligner cannot align are skipped without composing.
+    prefilter = Prefilter(
+      (symbols.find(ilabel) if ilabel else None,
+       symbols.find(olabel) if olabel else None)
+      for (ilabel, olabel) in mappings)
+    self._prefilter = prefilter
     matched = 0
     # ... and realign with it, counting how many alignments succeed, and
     # computing how many homophones there are.
@@ -167,39 +264,172 @@ class Aligner:
     output_homophones = collections.defaultdict(int) 
     matching_homophones = collections.defaultdict(int)
     for (p1, p2) in pairs:
-      f1 = self._make_fst(p1, symbols)
-      f2 = self._make_fst(p2, symbols)
-      alignment = py.shortestpath(f1 * self._aligner * f2).topsort()
-      if alignment.num_states() == 0:
+      if not prefilter.feasible(p1, p2):
         continue
-      inp = []
-      out = []
-      n_deletions = 0
-      n_insertions = 0
-      for s in alignment.states():
-        aiter = alignment.arcs(s)
-        while not aiter.done():
-          arc = aiter.value()
-          if arc.ilabel:
-            inp.append(symbols.find(arc.ilabel))
-          else:
-            inp.append("-")
-            n_insertions += 1
-          if arc.olabel:
-            out.append(symbols.find(arc.olabel))
-          else:
-            out.append("-")
-            n_deletions += 1
-          aiter.next()
+      alignment = self._align(p1, p2)
+      if alignment is None:
+        continue
+      inp, out, n_zeroes = alignment
       inp = " ".join(inp).encode("utf8")
       input_homophones[inp] += 1
       out = " ".join(out).encode("utf8")
       output_homophones[out] += 1
-      if n_deletions + n_insertions <= max_zeroes:
+      if n_zeroes <= max_zeroes:
         matched += 1
         match = "{}\t{}".format(inp.decode("utf8"), out.decode("utf8"))
         print(match)
         matching_homophones[match] += 1
+    print("PREFILTERED:\t{}\t{}\t{}".format(prefilter.rejected["length"],
+                                            prefilter.rejected["partners"],
+                                            prefilter.rejected["alignment"]))
+    self._print_homophones(input_homophones,
+                           output_homophones,
+                           matching_homophones)
+    return matched
+
+  def _compute_initial_alignments(self, pairs, max_zeroes,
+                                  max_allowed_mappings, print_mappings):
+    """Fast path for compute_alignments when only initials are considered.
+
+    With single-symbol pairs every pair aligns to its own substitution arc in
+    the first-pass aligner, since that arc costs at most -log(1/tot), far less
+    than a deletion plus an insertion. The realignment counts are therefore
+    just the initial-by-initial contingency table, and a pair matches in the
+    final pass iff its (initial, initial) mapping survives pruning. This
+    computes the same mappings, matches and printed output as the FST path
+    without building or composing any FSTs.
+
+    Args:
+      pairs: list of pairs, each side a non-empty list of one symbol
+      max_zeroes: int, maximum number of insertions/deletions
+      max_allowed_mappings: int, maximum number of mappings allowed
+      print_mappings: bool, whether or not to print mappings
+    Returns:
+      number of matches
+    """
+    table = collections.defaultdict(lambda: collections.defaultdict(int))
+    # Assigns labels in the order the FST path adds them to its symbol table,
+    # so that the mappings are printed in the same order.
+    labels = {"<epsilon>": 0}
+    for (p1, p2) in pairs:
+      if p2[0] not in table[p1[0]]:
+        labels.setdefault(p1[0], len(labels))
+        labels.setdefault(p2[0], len(labels))
+      table[p1[0]][p2[0]] += 1
+    symbols = {label: c for (c, label) in labels.items()}
+    mappings = set()
+    for left in table:
+      d = table[left]
+      rights = sorted(d, key=d.get, reverse=True)[:max_allowed_mappings]
+      for right in rights:
+        mappings.add((labels[left], labels[right]))
+    if print_mappings:
+      for (ilabel, olabel) in mappings:
+        print("{}\t->\t{}".format(symbols[ilabel], symbols[olabel]))
+    allowed = {(symbols[ilabel], symbols[olabel])
+               for (ilabel, olabel) in mappings}
+    self._allowed = allowed
+    matched = 0
+    input_homophones = collections.defaultdict(int)
+    output_homophones = collections.defaultdict(int)
+    matching_homophones = collections.defaultdict(int)
+    # The prefilter of the FST path rejects these pairs for lack of partners,
+    # since an initial-only aligner has no deletions or insertions.
+    rejected = 0
+    for (p1, p2) in pairs:
+      if (p1[0], p2[0]) not in allowed:
+        rejected += 1
+        continue
+      inp = p1[0].encode("utf8")
+      input_homophones[inp] += 1
+      out = p2[0].encode("utf8")
+      output_homophones[out] += 1
+      if max_zeroes >= 0:
+        matched += 1
+        match = "{}\t{}".format(p1[0], p2[0])
+        print(match)
+        matching_homophones[match] += 1
+    print("PREFILTERED:\t0\t{}\t0".format(rejected))
+    self._print_homophones(input_homophones,
+                           output_homophones,
+                           matching_homophones)
+    return matched
+
+  def match_matrix(self, pairs, max_zeroes=2, initial_only=False):
+    """Computes which first sides match which second sides.
+
+    Uses the criterion learned by the last call to compute_alignments, which
+    should have been given the same pairs and arguments. Each distinct
+    pairing of forms is aligned only once.
+
+    Args:
+      pairs: list of pairs
+      max_zeroes: int, maximum number of insertions/deletions
+      initial_only: bool, if True, only look at the initial segment
+    Returns:
+      boolean matrix whose [i, j] entry is True if the first side of pairs[i]
+      matches the second side of pairs[j]
+    """
+    if initial_only:
+      pairs = [(p1[:1], p2[:1]) for (p1, p2) in pairs]
+    lefts = [tuple(p1) for (p1, _) in pairs]
+    rights = [tuple(p2) for (_, p2) in pairs]
+    matches = {}
+    for p1 in set(lefts):
+      for p2 in set(rights):
+        if self._allowed is not None:
+          matches[p1, p2] = (max_zeroes >= 0 and
+                             (p1[0], p2[0]) in self._allowed)
+        elif not self._prefilter.feasible(p1, p2):
+          matches[p1, p2] = False
+        else:
+          alignment = self._align(p1, p2)
+          matches[p1, p2] = (alignment is not None and
+                             alignment[2] <= max_zeroes)
+    matrix = np.zeros((len(pairs), len(pairs)), dtype=bool)
+    for (i, p1) in enumerate(lefts):
+      for (j, p2) in enumerate(rights):
+        matrix[i, j] = matches[p1, p2]
+    return matrix
+
+  def _align(self, p1, p2):
+    """Aligns a pair with the pared down aligner.
+
+    Args:
+      p1: list of symbols
+      p2: list of symbols
+    Returns:
+      the aligned input and output symbols, with "-" for epsilon, and the
+      number of insertions plus deletions, or None if there is no alignment
+    """
+    symbols = self._symbols
+    f1 = self._make_fst(p1, symbols)
+    f2 = self._make_fst(p2, symbols)
+    alignment = py.shortestpath(f1 * self._aligner * f2).topsort()
+    if alignment.num_states() == 0:
+      return None
+    inp = []
+    out = []
+    n_zeroes = 0
+    for s in alignment.states():
+      aiter = alignment.arcs(s)
+      while not aiter.done():
+        arc = aiter.value()
+        if arc.ilabel:
+          inp.append(symbols.find(arc.ilabel))
+        else:
+          inp.append("-")
+          n_zeroes += 1
+        if arc.olabel:
+          out.append(symbols.find(arc.olabel))
+        else:
+          out.append("-")
+          n_zeroes += 1
+        aiter.next()
+    return inp, out, n_zeroes
+
+  def _print_homophones(self, input_homophones, output_homophones,
+                        matching_homophones):
     # Counts the homophone groups --- the number of unique forms each of which
     # is assigned to more than one slot, for each language.
     inp_lang_homophones = 0
@@ -216,7 +446,6 @@ class Aligner:
       if matching_homophones[match] > 1:
         print("HOMOPHONE:\t{}\t{}".format(
           matching_homophones[match], match))
-    return matched
 
   def _make_fst(self, string, symbols):
     fst = py.Fst()
@@ -247,15 +476,54 @@ def load_examples(f, parser):
   return pairs
 
 
+def permutation_test(matrix, permutations, batch_size=1000):
+  """Kessler's permutation test over a match matrix.
+
+  Ref: Kessler, Brett. 2001. "The Significance of Word Lists."
+  University of Chicago Press.
+
+  Args:
+    matrix: boolean matrix, output of Aligner.match_matrix
+    permutations: int, number of random permutations
+    batch_size: int, number of permutations to evaluate at once
+  Returns:
+    number of matches in the actual pairing, and the estimated probability of
+    at least as many under a random pairing
+  """
+  n = len(matrix)
+  rows = np.arange(n)
+  observed = int(matrix[rows, rows].sum())
+  rng = np.random.default_rng()
+  at_least = 0
+  for start in range(0, permutations, batch_size):
+    batch = min(batch_size, permutations - start)
+    columns = rng.permuted(np.tile(rows, (batch, 1)), axis=1)
+    counts = matrix[rows, columns].sum(axis=1)
+    at_least += int((counts >= observed).sum())
+  # Counts the actual pairing as one of the permutations, so that the
+  # estimate is never 0.
+  return observed, (at_least + 1) / (permutations + 1)
+
+
 def main(unused_argv):
   parser = lambda x: x.split()
   pairs = load_examples(FLAGS.examples, parser)
   aligner = Aligner()
-  print(aligner.compute_alignments(
+  matched = aligner.compute_alignments(
     pairs,
     max_zeroes=FLAGS.max_zeroes,
     max_allowed_mappings=FLAGS.max_allowed_mappings,
-    initial_only=FLAGS.initial_only))
+    initial_only=FLAGS.initial_only)
+  if FLAGS.permutations:
+    matrix = aligner.match_matrix(pairs,
+                                  max_zeroes=FLAGS.max_zeroes,
+                                  initial_only=FLAGS.initial_only)
+    observed, p = permutation_test(matrix, FLAGS.permutations)
+    sys.stderr.write(
+      ("Prob of k>={} cognates per permutation test "
+       "over {} permutations: {:.2e}\n").format(
+      observed, FLAGS.permutations, p))
+  print(matched)
   
 
 if __name__ == "__main__":
@@ -12,7 +12,9 @@
 
 """Computes R data from the output of generate_random_cognate_lists.py.
 
-Also computes the likelihood of the observed number of cognates.
+Also computes the likelihood of the observed number of cognates. If the runs
+were generated with --split_to, also computes the multilevel-splitting
+estimate of that likelihood.
 """
 
 from absl import app
@@ -52,6 +54,22 @@ def poisson(lam, n, highest_k):
     return 0
 
 
+def read_runs(path):
+  """Reads the RUN lines.
+
+  Args:
+    path: Path to the output of generate_random_cognate_lists.py
+  Returns:
+    A list of the fields of each RUN line, from the experiment number on.
+  """
+  runs = []
+  with open(path) as stream:
+    for line in stream:
+      if line.startswith("RUN"):
+        runs.append(line.split()[1:])
+  return runs
+
+
 def compute_bins(path):
   """Computes the bin counts for numbers of cognates in each simulation.
 
@@ -61,32 +79,150 @@ def compute_bins(path):
     A histogram of the numbers of cognates.
   """
   bins = collections.defaultdict(int)
-  with open(path) as stream:
-    for line in stream:
-      if line.startswith("RUN"):
-        _, _, n_cognates = line.split()
-        bins[int(n_cognates)] += 1
+  for fields in read_runs(path):
+    bins[int(fields[1])] += 1
   return bins
 
 
+def compute_trials(path):
+  """Collects the number of cognates and log weight of the runs of each trial.
+
+  Args:
+    path: Path to the output of generate_random_cognate_lists.py --split_to
+  Returns:
+    A list of the runs of each trial, as (number of cognates, log weight)
+    pairs, or an empty list if the runs are unweighted.
+  """
+  trials = collections.defaultdict(list)
+  for fields in read_runs(path):
+    if len(fields) < 3:
+      return []
+    trials[fields[0]].append((int(fields[1]), float(fields[2])))
+  return list(trials.values())
+
+
+def log_sum(log_xs):
+  """Returns the log of the sum of numbers given by their logs.
+
+  The logs can be far outside the range of floats, so the numbers are scaled
+  by the largest before adding them up.
+
+  Args:
+    log_xs: list of logs
+  Returns:
+    float
+  """
+  scale = max(log_xs, default=-math.inf)
+  if scale == -math.inf:
+    return scale
+  return scale + math.log(sum(math.exp(log_x - scale) for log_x in log_xs))
+
+
+def compute_weighted_bins(trials):
+  """Estimates the probability of each number of cognates from the trials.
+
+  Args:
+    trials: list of lists of (number of cognates, log weight) pairs
+  Returns:
+    A dict of the log probability of each number of cognates.
+  """
+  log_weights = collections.defaultdict(list)
+  for runs in trials:
+    for (n_cognates, log_weight) in runs:
+      log_weights[n_cognates].append(log_weight)
+  return {n_cognates: log_sum(logs) - math.log(len(trials))
+          for (n_cognates, logs) in log_weights.items()}
+
+
+def tail_probability(trials, n):
+  """Multilevel-splitting estimate of the probability of n or more cognates.
+
+  Each trial gives an unbiased estimate, so the trials are averaged, and the
+  standard error follows from their spread. If a few trials carry most of the
+  estimate, that standard error is itself unreliable, which the effective
+  number of trials, computed like an effective sample size, tells.
+
+  Args:
+    trials: list of lists of (number of cognates, log weight) pairs
+    n: true cognates
+  Returns:
+    the logs of the estimate and of its standard error, and the effective
+    number of trials
+  """
+  logs = [log_sum([log_weight for (n_cognates, log_weight) in runs
+                   if n_cognates >= n])
+          for runs in trials]
+  scale = max(logs)
+  if scale == -math.inf:
+    return -math.inf, -math.inf, 0
+  estimates = [math.exp(log_x - scale) for log_x in logs]
+  p = sum(estimates) / len(estimates)
+  effective_trials = sum(estimates) ** 2 / sum(x ** 2 for x in estimates)
+  if len(estimates) < 2:
+    return scale + math.log(p), math.inf, effective_trials
+  var = sum((x - p) ** 2 for x in estimates) / (len(estimates) - 1)
+  return (scale + math.log(p),
+          scale + 0.5 * math.log(var / len(estimates)) if var else -math.inf,
+          effective_trials)
+
+
+def format_log(log_x):
+  """Formats a number given by its log like "{:.2e}", without underflow."""
+  if log_x in (-math.inf, math.inf):
+    return "{:.2e}".format(math.exp(log_x))
+  exponent = math.floor(log_x / math.log(10))
+  mantissa = math.exp(log_x - exponent * math.log(10))
+  if round(mantissa, 2) >= 10:
+    mantissa /= 10
+    exponent += 1
+  return "{:.2f}e{:+03d}".format(mantissa, exponent)
+
+
 def main(unused_argv):
-  bins = compute_bins(FLAGS.path)
+  trials = compute_trials(FLAGS.path)
   mass = 0
   # Compute the mean, lambda
   lam = 0
   total = 0
-  for n_cognates in sorted(bins):
-    count = bins[n_cognates]
-    print("{}\t{}".format(n_cognates, count))
-    lam += count * n_cognates
-    total += count
-  lam /= total
+  if trials:
+    # The runs of the splitting trials are not a sample of the null
+    # distribution, so print the estimated probability of each number of
+    # cognates instead of the number of runs.
+    log_bins = compute_weighted_bins(trials)
+    for n_cognates in sorted(log_bins):
+      print("{}\t{}".format(n_cognates, format_log(log_bins[n_cognates])))
+      lam += math.exp(log_bins[n_cognates]) * n_cognates
+  else:
+    bins = compute_bins(FLAGS.path)
+    for n_cognates in sorted(bins):
+      count = bins[n_cognates]
+      print("{}\t{}".format(n_cognates, count))
+      lam += count * n_cognates
+      total += count
+    lam /= total
   sys.stderr.write(
     ("Prob of k>={} cognates per Poisson "
      "estimate with lambda={}: {:.2e}\n").format(
     FLAGS.true_count,
     lam,
     poisson(lam, FLAGS.true_count, FLAGS.arbitrary_max)))
+  if trials:
+    log_p, log_se, effective_trials = tail_probability(trials,
+                                                       FLAGS.true_count)
+    reaching = sum(any(n_cognates >= FLAGS.true_count
+                       for (n_cognates, _) in runs)
+                   for runs in trials)
+    # If a few trials carry most of the estimate, neither it nor its standard
+    # error can be trusted, so none is given.
+    if effective_trials < 10:
+      estimate = "unreliable, with fewer than 10 effective trials"
+    else:
+      estimate = "{} (s.e. {})".format(format_log(log_p), format_log(log_se))
+    sys.stderr.write(
+      ("Prob of k>={} cognates per multilevel-splitting estimate over {} "
+       "trials, {} of them reaching the true count, for an effective number "
+       "of trials of {:.1f}: {}\n").format(
+      FLAGS.true_count, len(trials), reaching, effective_trials, estimate))
 
 
 if __name__ == "__main__":
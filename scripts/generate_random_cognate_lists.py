@@ -24,9 +24,19 @@ from absl import flags
 
 import aligner
 import collections
+import contextlib
+import copy
+import fcntl
+import functools
+import hashlib
+import io
+import math
+import os
+import pickle
 import pynini as py
 import random
 import sys
+import tempfile
 import time
 
 
@@ -54,6 +64,41 @@ flags.DEFINE_integer("max_distinct_roots", -1,
 flags.DEFINE_bool("print_mappings", True,
                   "If using the alignment method, print found mapping rules.")
 flags.DEFINE_bool("use_aligner", False, "Uses alignment method in aligner.py")
+flags.DEFINE_integer("split_to", 0,
+                     "If positive, estimates the probabilities of up to this "
+                     "many matches by multilevel splitting, which reaches "
+                     "counts far beyond those of plain experiments. Each "
+                     "experiment is then a trial with --runs_per_level runs "
+                     "with at least k matches for each k up to this value, "
+                     "so it costs about this many times --runs_per_level "
+                     "runs. Each run is printed with the log of its weight "
+                     "for compute_stats.py, which averages over the trials.")
+flags.DEFINE_integer("runs_per_level", 100,
+                     "Number of runs at each level of a --split_to trial.")
+flags.DEFINE_integer("changes_per_run", 4,
+                     "Number of random changes to the etyma of a run at one "
+                     "--split_to level to get a run at the next. More changes "
+                     "make the runs of a level less alike, but are more often "
+                     "undone for losing matches.")
+flags.DEFINE_string("checkpoint", "",
+                    "If set, periodically saves the experiment counter, the "
+                    "random state and the results so far to this path.")
+flags.DEFINE_integer("checkpoint_every", 10,
+                     "Number of experiments between checkpoints")
+flags.DEFINE_bool("resume", False,
+                  "Continues the run saved in --checkpoint up to "
+                  "--number_of_experiments. The saved experiments are "
+                  "printed again, so write the output to a new file.")
+flags.DEFINE_integer("extend_to", 0,
+                     "If set, continues the run saved in --checkpoint, "
+                     "finished or not, up to this many experiments.")
+flags.DEFINE_string("cache_dir", "",
+                    "If set, saves the experiments in this directory, keyed "
+                    "by the contents of the lists and the flags that affect "
+                    "the results, instead of in --checkpoint. A later run "
+                    "with the same key prints the saved experiments and only "
+                    "runs the ones still missing. Concurrent runs with the "
+                    "same key wait for each other.")
 
 FLAGS = flags.FLAGS
 
@@ -72,8 +117,24 @@ class Roots:
       random.shuffle(entries)
       entries = entries[:max_distinct_roots]
     self._entries = []
+    self._counts = {}
     for (root, count) in entries:
       self._entries += [root] * count
+      self._counts[root] = count
+
+  @property
+  def counts(self):
+    """Number of entries of each distinct root."""
+    return self._counts
+
+  @property
+  def entries(self):
+    """Entries in their current order, which produce_etyma shuffles in place."""
+    return self._entries
+
+  @entries.setter
+  def entries(self, entries):
+    self._entries = entries
 
   def produce_etyma(self):
     """Produces etyma with no more than FLAGS.max_homophones homophones.
@@ -97,6 +158,85 @@ class Roots:
     return etyma
 
 
+class Shuffle:
+  """The start of a random shuffle of the entries of a Roots.
+
+  produce_etyma takes the etyma from the first entries of a shuffle of all the
+  entries, so only these are drawn here, as needed. The rest of the shuffle is
+  a random order of the entries not drawn yet. The shuffle can be changed by
+  swapping one of its first FLAGS.number_of_etyma entries with any entry,
+  which is just as likely as swapping them back. The changes thus make a
+  Markov chain that keeps the distribution of the etyma, which is that of
+  produce_etyma. Likewise for the random order of the etyma.
+  """
+
+  def __init__(self, roots):
+    self._roots = roots
+    self._entries = []
+    # Number of entries of each root among those drawn.
+    self._drawn = collections.defaultdict(int)
+    self._order = list(range(FLAGS.number_of_etyma))
+    random.shuffle(self._order)
+
+  def etyma(self):
+    """Produces etyma as produce_etyma does from this shuffle.
+
+    Returns:
+      List of FLAGS.number_of_etyma etyma.
+    """
+    etyma = []
+    homophone_counts = collections.defaultdict(int)
+    i = 0
+    while len(etyma) < FLAGS.number_of_etyma:
+      if i == len(self._entries):
+        self._entries.append(self._draw())
+      root = self._entries[i]
+      i += 1
+      if homophone_counts[root] >= FLAGS.max_homophones:
+        continue
+      etyma.append(root)
+      homophone_counts[root] += 1
+    return [etyma[j] for j in self._order]
+
+  def changed(self):
+    """Returns a copy of the shuffle with one random change.
+
+    Either two etyma swap places in the order of the etyma, or one of the
+    first FLAGS.number_of_etyma entries swaps places with a random entry.
+    """
+    shuffle = copy.copy(self)
+    shuffle._order = list(self._order)
+    shuffle._entries = list(self._entries)
+    shuffle._drawn = self._drawn.copy()
+    if random.random() < 0.5:
+      (i, j) = random.sample(range(len(self._order)), 2)
+      shuffle._order[i], shuffle._order[j] = self._order[j], self._order[i]
+      return shuffle
+    i = random.randrange(FLAGS.number_of_etyma)
+    j = random.randrange(len(self._roots.entries))
+    if j < len(self._entries):
+      shuffle._entries[i], shuffle._entries[j] = (self._entries[j],
+                                                  self._entries[i])
+    else:
+      # Any entry not drawn yet is equally likely to be at position j.
+      shuffle._drawn[self._entries[i]] -= 1
+      shuffle._entries[i] = shuffle._draw()
+    return shuffle
+
+  def _draw(self):
+    """Draws one of the entries not drawn yet, by rejection from all of them.
+
+    Returns:
+      A root
+    """
+    counts = self._roots.counts
+    while True:
+      root = random.choice(self._roots.entries)
+      if random.random() * counts[root] < counts[root] - self._drawn[root]:
+        self._drawn[root] += 1
+        return root
+
+
 def produce_paired_etyma(roots1, roots2):
   """Produce a paired list of etyma.
 
@@ -125,56 +265,381 @@ def best_score(match):
   return float("inf")
 
 
-def run_experiments(roots1, roots2):
-  """Runs FLAGS.number_of_experiments experiments.
+def label_sets(fst):
+  """Returns the sets of non-epsilon input and output labels of an FST.
 
   Args:
-    roots1: A Roots class instance
-    roots2: A Roots class instance
+    fst: an FST
+  Returns:
+    set of input labels, set of output labels
   """
-  mapping_rule = py.Far(FLAGS.far)[FLAGS.mapping_rule]
-  for i in range(FLAGS.number_of_experiments):
-    zipped = produce_paired_etyma(roots1, roots2)
-    success = 0
-    for (e1, e2) in zipped:
-      if best_score(e1 * mapping_rule * e2) <= FLAGS.levenshtein_threshold:
-        print("{}\t{}".format(e1, e2))
-        success += 1
+  input_labels = set()
+  output_labels = set()
+  for s in fst.states():
+    aiter = fst.arcs(s)
+    while not aiter.done():
+      arc = aiter.value()
+      if arc.ilabel:
+        input_labels.add(arc.ilabel)
+      if arc.olabel:
+        output_labels.add(arc.olabel)
+      aiter.next()
+  return input_labels, output_labels
+
+
+def print_run(i, success, log_weight):
+  """Prints the result of one run.
+
+  The log weight is only printed for multilevel splitting.
+
+  Args:
+    i: experiment number
+    success: number of matches
+    log_weight: log weight of the run
+  """
+  if FLAGS.split_to:
+    print("RUN:\t{}\t{}\t{!r}".format(i, success, log_weight))
+  else:
     print("RUN:\t{}\t{}".format(i, success))
-    sys.stdout.flush()
+  sys.stdout.flush()
+
+
+def file_hash(path):
+  """Returns the SHA-256 hex digest of the contents of a file."""
+  with open(path, "rb") as stream:
+    return hashlib.sha256(stream.read()).hexdigest()
+
+
+def simulation_params():
+  """Returns the flags that affect the outcome of the experiments.
+
+  Files are represented by a hash of their contents rather than their path.
+  """
+  names = ["max_distinct_roots", "max_homophones", "number_of_etyma",
+           "use_aligner", "split_to"]
+  files = ["list1", "list2"]
+  if FLAGS.split_to:
+    names += ["runs_per_level", "changes_per_run"]
+  if FLAGS.use_aligner:
+    names += ["max_zeroes", "max_allowed_mappings", "initial_only"]
+  else:
+    names += ["mapping_rule", "levenshtein_threshold"]
+    files += ["far"]
+  params = {name: FLAGS[name].value for name in names}
+  for name in files:
+    params[name] = file_hash(FLAGS[name].value)
+  return params
+
+
+def cache_path(params):
+  """Returns the path of the cached experiments for params in FLAGS.cache_dir.
+
+  Args:
+    params: dict, output of simulation_params
+  Returns:
+    path
+  """
+  key = hashlib.sha256(repr(sorted(params.items())).encode("utf8"))
+  return os.path.join(FLAGS.cache_dir, key.hexdigest())
+
+
+def lock(path):
+  """Waits for and takes an exclusive lock on path, via a ".lock" sidecar.
 
+  The lock is held until the returned file is closed or the process exits.
 
-def run_experiments_with_aligner(roots1, roots2, initial_only=False):
-  """Runs FLAGS.number_of_experiments experiments, using new aligner
+  Args:
+    path: path of the checkpoint
+  Returns:
+    the open lock file
+  """
+  stream = open(path + ".lock", "w")
+  fcntl.flock(stream, fcntl.LOCK_EX)
+  return stream
+
+
+class Checkpoint:
+  """State of a series of experiments, saved so that it can be continued.
+
+  Besides the results so far, keeps the random state from before the roots
+  were loaded, so that a resumed run samples the same distinct roots, and the
+  random state and the order of the entries of each Roots after the last
+  recorded experiment.
+  """
+
+  def __init__(self, path, params):
+    self._path = path
+    self.params = params
+    self.initial_state = random.getstate()
+    self.state = None
+    self.entries = None
+    # The Roots whose entries are saved.
+    self.roots = []
+    # Number of matches and log weight of each run of each experiment.
+    self.runs = []
+
+  @property
+  def next_experiment(self):
+    return len(self.runs)
+
+  @classmethod
+  def load(cls, path, params):
+    """Loads a checkpoint, checking that it was made with the same params.
+
+    Args:
+      path: path to the checkpoint
+      params: dict, output of simulation_params
+    Returns:
+      A Checkpoint class instance
+    """
+    if not os.path.exists(path):
+      raise app.UsageError("No checkpoint at {}".format(path))
+    with open(path, "rb") as stream:
+      saved = pickle.load(stream)
+    for name in params:
+      if saved["params"].get(name) != params[name]:
+        raise app.UsageError(
+          "--{}={} does not match {} in checkpoint {}".format(
+            name, params[name], saved["params"].get(name), path))
+    checkpoint = cls(path, saved["params"])
+    checkpoint.initial_state = saved["initial_state"]
+    checkpoint.state = saved["state"]
+    checkpoint.entries = saved["entries"]
+    checkpoint.runs = saved["runs"]
+    return checkpoint
+
+  def record(self, runs):
+    """Records the runs of an experiment, saving every FLAGS.checkpoint_every.
+
+    Args:
+      runs: list of (number of matches, log weight) pairs
+    """
+    self.runs.append(runs)
+    if self.next_experiment % FLAGS.checkpoint_every == 0:
+      self.save()
+
+  def save(self):
+    """Saves the checkpoint, if there is a path, replacing it atomically."""
+    if not self._path:
+      return
+    self.state = random.getstate()
+    self.entries = [roots.entries for roots in self.roots]
+    # A temporary file of its own, in case another run saves to the same path.
+    descriptor, tmp = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(self._path)))
+    with os.fdopen(descriptor, "wb") as stream:
+      pickle.dump({"params": self.params,
+                   "initial_state": self.initial_state,
+                   "state": self.state,
+                   "entries": self.entries,
+                   "runs": self.runs}, stream)
+    os.replace(tmp, self._path)
+
+
+def count_matches(pairs, mapping_rule, input_labels, output_labels):
+  """Counts the pairs of etyma that the mapping rule matches.
+
+  Prints the matching pairs and the number of pairs skipped without composing.
+
+  Args:
+    pairs: pairs of etyma
+    mapping_rule: an FST
+    input_labels: set of input labels of mapping_rule
+    output_labels: set of output labels of mapping_rule
+  Returns:
+    number of matches
+  """
+  success = 0
+  rejected = 0
+  for (e1, e2) in pairs:
+    if not (input_labels.issuperset(e1.encode("utf8")) and
+            output_labels.issuperset(e2.encode("utf8"))):
+      rejected += 1
+      continue
+    if best_score(e1 * mapping_rule * e2) <= FLAGS.levenshtein_threshold:
+      print("{}\t{}".format(e1, e2))
+      success += 1
+  print("PREFILTERED:\t{}".format(rejected))
+  return success
+
+
+def count_alignments(pairs, initial_only=False):
+  """Counts the pairs of etyma that the new aligner matches.
 
   Note we assume that the input and output can be split on space!
 
+  Args:
+    pairs: pairs of etyma
+    initial_only: bool, if True, only look at the initial segment
+  Returns:
+    number of matches
+  """
+  zipped = [(c1.split(), c2.split()) for (c1, c2) in pairs]
+  the_aligner = aligner.Aligner()
+  return the_aligner.compute_alignments(
+    zipped,
+    max_zeroes=FLAGS.max_zeroes,
+    max_allowed_mappings=FLAGS.max_allowed_mappings,
+    print_mappings=FLAGS.print_mappings,
+    initial_only=initial_only)
+
+
+def run_experiments(roots1, roots2, checkpoint, number_of_experiments, count):
+  """Runs experiments up to number_of_experiments.
+
   Args:
     roots1: A Roots class instance
     roots2: A Roots class instance
+    checkpoint: A Checkpoint class instance
+    number_of_experiments: int, total number of experiments
+    count: function counting the matches in a list of pairs of etyma
   """
-  for i in range(FLAGS.number_of_experiments):
-    zipped = [(c1.split(), c2.split())
-                for (c1, c2) in produce_paired_etyma(roots1, roots2)]
-    success = 0
-    the_aligner = aligner.Aligner()
-    success = the_aligner.compute_alignments(
-      zipped,
-      max_zeroes=FLAGS.max_zeroes,
-      max_allowed_mappings=FLAGS.max_allowed_mappings,
-      print_mappings=FLAGS.print_mappings,
-      initial_only=initial_only)
-    print("RUN:\t{}\t{}".format(i, success))
-    sys.stdout.flush()
+  for i in range(checkpoint.next_experiment, number_of_experiments):
+    success = count(produce_paired_etyma(roots1, roots2))
+    print_run(i, success, 0)
+    checkpoint.record([(success, 0)])
+
+
+def count_shuffles(shuffles, count):
+  """Counts the matches between the etyma of two shuffles.
+
+  Args:
+    shuffles: pair of Shuffle class instances
+    count: function counting the matches in a list of pairs of etyma
+  Returns:
+    the shuffles, the number of matches, and what count printed
+  """
+  with contextlib.redirect_stdout(io.StringIO()) as output:
+    success = count(list(zip(shuffles[0].etyma(), shuffles[1].etyma())))
+  return shuffles, success, output.getvalue()
+
+
+def run_split_experiments(roots1, roots2, checkpoint, number_of_experiments,
+                          count):
+  """Runs multilevel splitting trials up to number_of_experiments.
+
+  Each trial has FLAGS.runs_per_level runs at each level k from 0 to
+  FLAGS.split_to, the runs at level k having at least k matches. Those at
+  level 0 are plain runs. The fraction of the runs at level k with more than
+  k matches estimates the probability of more than k matches given at least
+  k. Each run at level k + 1 starts from one of those: it is that run after
+  FLAGS.changes_per_run random changes if it still has more than k matches,
+  and that run unchanged otherwise. Since the changes keep the distribution
+  of the etyma, this keeps it restricted to more than k matches.
+
+  The product of the fractions below level k thus estimates the probability
+  of at least k matches. The runs at level k with exactly k matches, or with
+  any number for the last level, share that estimate as their weights, and
+  the other runs have none. The weights of a trial add up to 1, and for any
+  n, those of the runs with at least n matches add up to an unbiased
+  estimate of the probability of at least n matches.
+
+  Args:
+    roots1: A Roots class instance
+    roots2: A Roots class instance
+    checkpoint: A Checkpoint class instance
+    number_of_experiments: int, total number of trials
+    count: function counting the matches in a list of pairs of etyma
+  """
+  for i in range(checkpoint.next_experiment, number_of_experiments):
+    population = [count_shuffles((Shuffle(roots1), Shuffle(roots2)), count)
+                  for _ in range(FLAGS.runs_per_level)]
+    # Log of the estimated probability of at least level matches.
+    log_probability = 0
+    runs = []
+    for level in range(FLAGS.split_to + 1):
+      for (_, success, output) in population:
+        if success == level or level == FLAGS.split_to:
+          log_weight = log_probability - math.log(FLAGS.runs_per_level)
+        else:
+          log_weight = -math.inf
+        sys.stdout.write(output)
+        print_run(i, success, log_weight)
+        runs.append((success, log_weight))
+      survivors = [run for run in population if run[1] > level]
+      if level == FLAGS.split_to or not survivors:
+        break
+      log_probability += math.log(len(survivors) / FLAGS.runs_per_level)
+      # Each survivor starts as many runs, give or take one, with the extra
+      # runs going to random survivors so that the estimates stay unbiased.
+      (quotient, remainder) = divmod(FLAGS.runs_per_level, len(survivors))
+      population = []
+      for run in (survivors * quotient +
+                  random.sample(survivors, remainder)):
+        shuffles = list(run[0])
+        for _ in range(FLAGS.changes_per_run):
+          k = random.randrange(2)
+          shuffles[k] = shuffles[k].changed()
+        changed = count_shuffles(shuffles, count)
+        population.append(changed if changed[1] > level else run)
+    checkpoint.record(runs)
 
 
 def main(unused_argv):
+  if FLAGS.split_to < 0:
+    raise app.UsageError("--split_to must not be negative")
+  if FLAGS.runs_per_level < 1 or FLAGS.changes_per_run < 1:
+    raise app.UsageError(
+      "--runs_per_level and --changes_per_run must be positive")
+  if FLAGS.checkpoint_every < 1:
+    raise app.UsageError("--checkpoint_every must be positive")
+  number_of_experiments = FLAGS.number_of_experiments
+  if FLAGS.extend_to:
+    number_of_experiments = FLAGS.extend_to
+  params = simulation_params()
+  path = FLAGS.checkpoint
+  if FLAGS.cache_dir:
+    if FLAGS.checkpoint:
+      raise app.UsageError("--cache_dir and --checkpoint are exclusive")
+    os.makedirs(FLAGS.cache_dir, exist_ok=True)
+    path = cache_path(params)
+  if path:
+    # Runs with the same checkpoint, e.g. the grouping runs sharing a cache
+    # entry, go one at a time, so that a later run continues an earlier one
+    # rather than simulating the same experiments and overwriting them.
+    lock_file = lock(path)
+  if FLAGS.cache_dir:
+    # A missing entry is simply a new run, even with --resume or --extend_to.
+    resume = os.path.exists(path)
+  else:
+    resume = FLAGS.resume or FLAGS.extend_to
+  if resume:
+    if not path:
+      raise app.UsageError("--resume and --extend_to require --checkpoint")
+    checkpoint = Checkpoint.load(path, params)
+    random.setstate(checkpoint.initial_state)
+  else:
+    checkpoint = Checkpoint(path, params)
+  # Prints the saved experiments, so that the output covers the whole run.
+  # Experiments after the last checkpoint are run again.
+  for (i, runs) in enumerate(checkpoint.runs[:number_of_experiments]):
+    for (success, log_weight) in runs:
+      print_run(i, success, log_weight)
   roots1 = Roots(FLAGS.list1, FLAGS.max_distinct_roots)
   roots2 = Roots(FLAGS.list2, FLAGS.max_distinct_roots)
+  checkpoint.roots = [roots1, roots2]
+  if checkpoint.state:
+    roots1.entries, roots2.entries = checkpoint.entries
+    random.setstate(checkpoint.state)
+  else:
+    checkpoint.save()
   if FLAGS.use_aligner:
-    run_experiments_with_aligner(roots1, roots2, FLAGS.initial_only)
+    count = functools.partial(count_alignments,
+                              initial_only=FLAGS.initial_only)
+  else:
+    mapping_rule = py.Far(FLAGS.far)[FLAGS.mapping_rule]
+    # The etyma are compiled as bytes, so a pair with a byte that the rule
+    # never reads or writes cannot match and is skipped without composing.
+    input_labels, output_labels = label_sets(mapping_rule)
+    count = functools.partial(count_matches, mapping_rule=mapping_rule,
+                              input_labels=input_labels,
+                              output_labels=output_labels)
+  if FLAGS.split_to:
+    run_split_experiments(roots1, roots2, checkpoint, number_of_experiments,
+                          count)
   else:
-    run_experiments(roots1, roots2)
+    run_experiments(roots1, roots2, checkpoint, number_of_experiments, count)
+  checkpoint.save()
 
 
 if __name__ == "__main__":
@@ -26,6 +26,9 @@ MAX_ALLOWED_MAPPINGS=2
 # We used 1000 in the experiments reported in Blevins & Sproat, but 100 is
 # generally sufficient.
 NEXP=1000
+# The simulation does not depend on the Swadesh list, so it is cached here and
+# shared by every Swadesh list run against the same pair of root lists.
+CACHE_DIR=scratch/null_cache
 # Computes the number of pairs from the Swadesh that are found by the alignment
 # algorithm. We use this as the "true" count of the Swadesh cognates.
 TRUE_COUNT=`python3 scripts/aligner.py \
@@ -43,7 +46,8 @@ python3 scripts/generate_random_cognate_lists.py \
     --max_zeroes="${MAX_ZEROES}" \
     --max_allowed_mappings="${MAX_ALLOWED_MAPPINGS}" \
     --print_mappings=1 \
-    --number_of_etyma=200 > scratch/tmp
+    --number_of_etyma=200 \
+    --cache_dir="${CACHE_DIR}" > scratch/tmp
 # Generates a matrix that can be loaded into, say, R, and computes the Poisson
 # probability of the "true" count given the simulations.
 python3 scripts/compute_stats.py \